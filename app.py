@@ -5,14 +5,20 @@ Streamlit Application for Optimal Ambulance Dispatch
 """
 
 import streamlit as st
-import osmnx as ox
 import networkx as nx
 import pandas as pd
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+import hashlib
+import os
+import pickle
 import random
+import uuid
 from pulp import *
-import folium
-from streamlit_folium import st_folium
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 # ============================================================================
@@ -33,8 +39,11 @@ COEF_INSUMOS = 3
 BETA = 0.5    # Time weight
 GAMMA = 1.0   # Operational cost weight
 
-# Big-M constraint
-M = 10000
+# Severity levels shared by ambulance types and emergency types
+NIVELES = {'Crítica': 3, 'Media': 2, 'Leve': 1}
+
+# OSMnx on-disk cache folder for downloaded OSM data
+OSMNX_CACHE = '.osmnx_cache'
 
 # Page configuration
 st.set_page_config(
@@ -45,121 +54,264 @@ st.set_page_config(
 )
 
 # ============================================================================
-# AMBULANCE CLASS (from original code)
+# AMBULANCE FLEET
 # ============================================================================
 
-class Ambulancia:
-    """Represents an ambulance with resources and operational cost."""
-    
-    def __init__(self, id, personal, equipamiento, insumos):
-        self.id = id
-        self.personal = personal
-        self.equipamiento = equipamiento
-        self.insumos = insumos
-        self.costo_operativo = self._calcular_costo_operativo()
-        self.tipo = self._asignar_tipo_ambulancia()
-    
-    def _calcular_costo_operativo(self):
-        return (self.personal * COEF_PERSONAL + 
-                self.equipamiento * COEF_EQUIPAMIENTO + 
-                self.insumos * COEF_INSUMOS)
-    
-    def _asignar_tipo_ambulancia(self):
-        if self.costo_operativo >= 200:
-            return 'Crítica'
-        elif self.costo_operativo >= 100:
-            return 'Media'
-        elif self.costo_operativo >= 50:
-            return 'Leve'
-        else:
-            return 'Desconocido'
+def calcular_costo_operativo(personal, equipamiento, insumos):
+    """Operational cost of ambulances (scalars or arrays)."""
+    return (personal * COEF_PERSONAL +
+            equipamiento * COEF_EQUIPAMIENTO +
+            insumos * COEF_INSUMOS)
+
+def tipo_ambulancia(costo_operativo):
+    """Ambulance type for an operational cost (scalar) or an array of costs."""
+    costo = np.asarray(costo_operativo)
+    tipo = np.select(
+        [costo >= 200, costo >= 100, costo >= 50],
+        ['Crítica', 'Media', 'Leve'],
+        'Desconocido'
+    )
+    return tipo.astype(object) if tipo.ndim else str(tipo)
+
+class Flota:
+    """Ambulance fleet stored as parallel NumPy arrays (one entry per ambulance)."""
+    
+    def __init__(self, ids, personal, equipamiento, insumos):
+        self.ids = np.array(ids, dtype=object)
+        self.personal = np.array(personal, dtype=np.int32)
+        self.equipamiento = np.array(equipamiento, dtype=np.int32)
+        self.insumos = np.array(insumos, dtype=np.int32)
+        self._recalcular()
+    
+    def _recalcular(self):
+        self.costo_operativo = calcular_costo_operativo(
+            self.personal, self.equipamiento, self.insumos
+        )
+        self.tipo = tipo_ambulancia(self.costo_operativo)
+    
+    def __len__(self):
+        return len(self.ids)
     
-    def to_dict(self):
-        return {
-            'ID': self.id,
+    def __contains__(self, amb_id):
+        return bool((self.ids == amb_id).any())
+    
+    def niveles(self):
+        """Severity level of each ambulance (0 for 'Desconocido')."""
+        return np.select(
+            [self.tipo == tipo for tipo in NIVELES],
+            list(NIVELES.values()),
+            0
+        )
+    
+    def agregar(self, amb_id, personal, equipamiento, insumos):
+        self.ids = np.append(self.ids, np.array([amb_id], dtype=object))
+        self.personal = np.append(self.personal, np.int32(personal))
+        self.equipamiento = np.append(self.equipamiento, np.int32(equipamiento))
+        self.insumos = np.append(self.insumos, np.int32(insumos))
+        self._recalcular()
+    
+    def eliminar(self, amb_id):
+        mascara = self.ids != amb_id
+        self.ids = self.ids[mascara]
+        self.personal = self.personal[mascara]
+        self.equipamiento = self.equipamiento[mascara]
+        self.insumos = self.insumos[mascara]
+        self.costo_operativo = self.costo_operativo[mascara]
+        self.tipo = self.tipo[mascara]
+    
+    def to_dataframe(self):
+        return pd.DataFrame({
+            'ID': self.ids,
             'Personal': self.personal,
             'Equipamiento': self.equipamiento,
             'Insumos': self.insumos,
             'Costo Operativo': self.costo_operativo,
             'Tipo': self.tipo
-        }
+        })
 
 # ============================================================================
 # UTILITY FUNCTIONS
 # ============================================================================
 
-def es_compatible(ambulancia, tipo_emergencia):
-    """Check if ambulance can handle emergency type."""
-    niveles_ambulancia = {'Crítica': 3, 'Media': 2, 'Leve': 1}
-    niveles_emergencia = {'Crítica': 3, 'Media': 2, 'Leve': 1}
-    
-    nivel_amb = niveles_ambulancia.get(ambulancia.tipo, 0)
-    nivel_emerg = niveles_emergencia.get(tipo_emergencia, 0)
+def agregar_restriccion(modelo, terminos, sentido, rhs, nombre):
+    """Add `sum(coef * var) <sentido> rhs` from (var, coef) pairs without copies."""
+    modelo += LpConstraint(
+        e=LpAffineExpression(terminos), sense=sentido, rhs=rhs, name=nombre
+    )
+
+def _coords_arco(G, u, v, datos):
+    """[lon, lat] points of arc u → v: its geometry, or a straight segment without one."""
+    if 'geometry' in datos:
+        return [list(punto) for punto in datos['geometry'].coords]
+    return [[G.nodes[u]['x'], G.nodes[u]['y']], [G.nodes[v]['x'], G.nodes[v]['y']]]
+
+def _contraer_cadenas(G):
+    """Splice chain nodes (one arc in, one arc out) into a single arc."""
+    from shapely.geometry import LineString
+    
+    # Merged arcs sum their lengths and join their geometries
+    for n in list(G.nodes()):
+        if G.in_degree(n) != 1 or G.out_degree(n) != 1:
+            continue
+        [(u, _, _, entrada)] = G.in_edges(n, keys=True, data=True)
+        [(_, v, _, salida)] = G.out_edges(n, keys=True, data=True)
+        if n in (u, v) or u == v:
+            continue
+        
+        datos = dict(entrada)
+        datos['length'] = entrada['length'] + salida['length']
+        datos['geometry'] = LineString(
+            _coords_arco(G, u, n, entrada) + _coords_arco(G, n, v, salida)[1:]
+        )
+        G.remove_node(n)
+        G.add_edge(u, v, **datos)
     
-    return nivel_amb >= nivel_emerg
+    return G
+
+def _ruta_red_en_disco(lat, lon, radio):
+    return os.path.join(OSMNX_CACHE, f"red_contraida_{lat}_{lon}_{radio}.pkl")
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
 def descargar_red(lat, lon, radio):
-    """Download street network from OSM."""
-    try:
+    """Download street network from OSM, shared across sessions and pickled to disk."""
+    # Errors propagate so that failed downloads are not cached
+    ruta = _ruta_red_en_disco(lat, lon, radio)
+    if os.path.exists(ruta):
+        with open(ruta, 'rb') as f:
+            G = pickle.load(f)
+    else:
+        import osmnx as ox
+        
+        ox.settings.use_cache = True
+        ox.settings.log_console = False
+        ox.settings.cache_folder = OSMNX_CACHE
+        
         G = ox.graph_from_point(
             (lat, lon),
             dist=radio,
             network_type='drive'
         )
-        return G
-    except Exception as e:
-        st.error(f"Error downloading network: {str(e)}")
-        return None
+        G = _contraer_cadenas(G)
+        
+        # Arc listing that per-arc arrays (lengths, capacities) are aligned
+        # with; the graph is never modified after download.
+        G.graph['_arcs'] = tuple(G.edges(keys=True))
+        
+        os.makedirs(OSMNX_CACHE, exist_ok=True)
+        with open(ruta, 'wb') as f:
+            pickle.dump(G, f, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    # Cache key of this graph object; unlike id(G) it is never reused by
+    # another graph once this one is dropped
+    G.graph['_clave'] = (lat, lon, radio, uuid.uuid4().hex)
+    return G
 
-def asignar_capacidades_velocidades(G, C_MIN, C_MAX, R_MIN, R_MAX):
-    """Assign capacities to edges and calculate travel times."""
-    arcos = list(G.edges(keys=True))
-    
-    # Assign capacities
-    for u, v, key in arcos:
-        capacidad = random.uniform(C_MIN, C_MAX)
-        G.edges[(u, v, key)]['Capacidad_C'] = capacidad
+def cargar_red():
+    """Load the study-area network, reporting download errors in the UI."""
+    with st.spinner("📡 Loading street network..."):
+        try:
+            return descargar_red(LATITUD_CENTRO, LONGITUD_CENTRO, RADIO_METROS)
+        except Exception as e:
+            st.error(f"Error downloading network: {str(e)}")
+            return None
+
+@st.cache_resource(show_spinner=False)
+def obtener_solver(limite_tiempo):
+    """Return the HiGHS solver, falling back to CBC if unavailable."""
+    hilos = os.cpu_count()
+    try:
+        from pulp import HiGHS_CMD
+        solver = HiGHS_CMD(msg=False, threads=hilos, timeLimit=limite_tiempo, warmStart=False)
+        if solver.available():
+            return solver
+    except (ImportError, PulpSolverError):
+        pass
+    return PULP_CBC_CMD(
+        msg=0, threads=hilos, timeLimit=limite_tiempo, warmStart=False, presolve=True
+    )
+
+def longitudes_arcos_km(G):
+    """Length (km) of every arc in G.graph['_arcs'], computed once per graph."""
+    if '_longitud_km' not in G.graph:
+        arcos = G.graph['_arcs']
         
-        # Calculate distance
-        if 'length' in G.edges[(u, v, key)]:
-            distancia_km = G.edges[(u, v, key)]['length'] / 1000
-        else:
-            x1, y1 = G.nodes[u]['x'], G.nodes[u]['y']
-            x2, y2 = G.nodes[v]['x'], G.nodes[v]['y']
-            distancia_km = ((x2-x1)**2 + (y2-y1)**2)**0.5 * 111
+        # Fall back to node coordinates for arcs without 'length'
+        longitudes = np.fromiter(
+            (G[u][v][key].get('length', np.nan) for u, v, key in arcos),
+            dtype=np.float64,
+            count=len(arcos)
+        )
+        distancias_km = longitudes / 1000
+        
+        sin_longitud = np.flatnonzero(np.isnan(longitudes))
+        if sin_longitud.size:
+            indice, coords = indice_coords_nodos(G)
+            origenes = coords[[indice[arcos[i][0]] for i in sin_longitud]].astype(np.float64)
+            llegadas = coords[[indice[arcos[i][1]] for i in sin_longitud]].astype(np.float64)
+            dx, dy = (llegadas - origenes).T
+            distancias_km[sin_longitud] = np.hypot(dx, dy) * 111
         
-        G.edges[(u, v, key)]['Distancia'] = distancia_km
-        tiempo_horas = distancia_km / capacidad
-        G.edges[(u, v, key)]['tiempo_min'] = tiempo_horas * 60
+        G.graph['_longitud_km'] = distancias_km.astype(np.float32)
+    
+    return G.graph['_longitud_km']
+
+@st.cache_resource(show_spinner=False)
+def obtener_ejecutor():
+    """Worker threads that run optimizations off the script thread."""
+    return ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="optimizacion")
+
+def indice_coords_nodos(G):
+    """Return (node_index, coords) of G, computed once per graph."""
+    # coords is a float32 (n_nodes, 2) array of [lon, lat] rows
+    if 'coords' not in G.graph:
+        G.graph['node_index'] = {n: i for i, n in enumerate(G.nodes())}
+        G.graph['coords'] = np.array(
+            [(datos['x'], datos['y']) for _, datos in G.nodes(data=True)],
+            dtype=np.float32
+        )
+    return G.graph['node_index'], G.graph['coords']
+
+def asignar_capacidades_velocidades(n_arcos, C_MIN, C_MAX, R_MIN, R_MAX, semilla):
+    """Draw link capacities and required speeds by emergency type."""
+    # Capacities in whole km/h (uint8 covers every sidebar value), one per
+    # arc of G.graph['_arcs']; the draw depends only on the arguments
+    rng = np.random.default_rng(semilla)
+    capacidades = rng.integers(C_MIN, C_MAX, size=n_arcos, endpoint=True, dtype=np.uint8)
     
     # Assign required speeds by emergency type
     rango = R_MAX - R_MIN
     tercio = rango / 3
     
     R_k = {
-        'Leve': random.uniform(R_MIN, R_MIN + tercio),
-        'Media': random.uniform(R_MIN + tercio, R_MIN + 2*tercio),
-        'Crítica': random.uniform(R_MIN + 2*tercio, R_MAX)
+        'Leve': float(rng.uniform(R_MIN, R_MIN + tercio)),
+        'Media': float(rng.uniform(R_MIN + tercio, R_MIN + 2*tercio)),
+        'Crítica': float(rng.uniform(R_MIN + 2*tercio, R_MAX))
     }
     
-    return R_k
+    return capacidades, R_k
 
-def generar_origen_destinos(G, num_incidentes):
+def generar_origen_destinos(G, num_incidentes, centralidad_exacta=False):
     """Generate origin and connected destinations."""
-    # Find largest strongly connected component
-    if not nx.is_strongly_connected(G):
-        componentes = list(nx.strongly_connected_components(G))
-        componente_mas_grande = max(componentes, key=len)
-        componente_principal = G.subgraph(componente_mas_grande).copy()
-    else:
+    # Find largest strongly connected component (single Tarjan pass)
+    componente_mas_grande = max(nx.strongly_connected_components(G), key=len)
+    if len(componente_mas_grande) == len(G):
         componente_principal = G
+    else:
+        componente_principal = G.subgraph(componente_mas_grande).copy()
     
     nodos_componente = list(componente_principal.nodes())
     
-    # Select origin (most central node)
+    # Select origin (most central node, sampled from 50 sources unless exact)
     try:
-        centralidad = nx.betweenness_centrality(componente_principal)
+        if centralidad_exacta:
+            centralidad = nx.betweenness_centrality(componente_principal)
+        else:
+            centralidad = nx.betweenness_centrality(
+                componente_principal,
+                k=min(50, len(nodos_componente)),
+                normalized=False,
+                seed=42
+            )
         ORIGEN = max(centralidad, key=centralidad.get)
     except:
         grados = {n: componente_principal.degree(n) for n in nodos_componente}
@@ -175,22 +327,65 @@ def generar_origen_destinos(G, num_incidentes):
     if len(candidatos) < num_incidentes:
         num_incidentes = len(candidatos)
     
-    destinos_nodos = random.sample(candidatos, num_incidentes)
+    # Sample destinations and a balanced, shuffled set of emergency types as
+    # integer codes (seeded from `random` so random.seed() stays in control)
+    FLUJOS = np.array(['Crítica', 'Media', 'Leve'], dtype=object)
+    rng = np.random.default_rng(random.getrandbits(64))
+    indices_destino = rng.choice(len(candidatos), size=num_incidentes, replace=False)
+    codigos_tipo = rng.permutation(np.arange(num_incidentes) % len(FLUJOS))
     
-    # Assign emergency types
-    FLUJOS = ['Crítica', 'Media', 'Leve']
-    tipos_emergencia = (FLUJOS * (num_incidentes // len(FLUJOS) + 1))[:num_incidentes]
-    random.shuffle(tipos_emergencia)
-    
-    DESTINOS = {nodo: tipo for nodo, tipo in zip(destinos_nodos, tipos_emergencia)}
+    DESTINOS = {
+        candidatos[i]: tipo
+        for i, tipo in zip(indices_destino.tolist(), FLUJOS[codigos_tipo].tolist())
+    }
     
     return ORIGEN, DESTINOS
 
-def resolver_optimizacion(G, ambulancias, ORIGEN, DESTINOS, R_k, factor_relajacion):
-    """Solve the multi-flow optimization model."""
+def construir_csr(G):
+    """CSR adjacency of G weighted by arc length (km), built once per graph."""
+    if '_csr' in G.graph:
+        return G.graph['_csr']
     
     nodos = list(G.nodes())
-    arcos = list(G.edges(keys=True))
+    indice, _ = indice_coords_nodos(G)
+    arcos = G.graph['_arcs']
+    
+    filas = np.fromiter((indice[u] for u, _, _ in arcos), dtype=np.int64, count=len(arcos))
+    columnas = np.fromiter((indice[v] for _, v, _ in arcos), dtype=np.int64, count=len(arcos))
+    pesos = longitudes_arcos_km(G)
+    
+    # Keep only the shortest of each group of parallel edges; arco_minimo maps
+    # a (row, row) pair to that edge's position in G.graph['_arcs']
+    orden = np.lexsort((pesos, columnas, filas))
+    filas, columnas, pesos = filas[orden], columnas[orden], pesos[orden]
+    primero = np.ones(len(filas), dtype=bool)
+    primero[1:] = (filas[1:] != filas[:-1]) | (columnas[1:] != columnas[:-1])
+    filas, columnas, pesos = filas[primero], columnas[primero], pesos[primero]
+    
+    matriz = csr_matrix((pesos, (filas, columnas)), shape=(len(nodos), len(nodos)))
+    arco_minimo = dict(zip(zip(filas.tolist(), columnas.tolist()), orden[primero].tolist()))
+    G.graph['_csr'] = (matriz, nodos, indice, arco_minimo)
+    return G.graph['_csr']
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def calcular_rutas(_G, clave_red, origen):
+    """Shortest distances (km) and predecessor rows from `origen` to all nodes."""
+    matriz, _, indice, _ = construir_csr(_G)
+    return dijkstra(matriz, directed=True, indices=indice[origen], return_predecessors=True)
+
+def _reconstruir_camino(predecesores, fila_destino):
+    """Rows of the path from the source to `fila_destino`, from the predecessor array."""
+    camino = []
+    fila = fila_destino
+    while fila >= 0:
+        camino.append(fila)
+        fila = predecesores[fila]
+    camino.reverse()
+    return camino
+
+def resolver_optimizacion(G, flota, ORIGEN, DESTINOS, R_k, capacidades, rutas, factor_relajacion,
+                          solver, usar_lp=False):
+    """Solve the ambulance dispatch model."""
     
     # Create priority mapping
     prioridades = {'Crítica': 3, 'Media': 2, 'Leve': 1}
@@ -205,357 +400,528 @@ def resolver_optimizacion(G, ambulancias, ORIGEN, DESTINOS, R_k, factor_relajaci
             'velocidad_requerida': R_k[tipo_emerg]
         })
     
-    # Create ambulance dictionary
-    ambulancias_dict = {amb.id: amb for amb in ambulancias}
+    # Ambulance attributes by id
+    costo_por_amb = dict(zip(flota.ids, flota.costo_operativo.tolist()))
+    tipo_por_amb = dict(zip(flota.ids, flota.tipo))
     
-    # Create compatible pairs
-    pares_amb_inc = []
-    for amb in ambulancias:
-        for inc in incidentes:
-            if es_compatible(amb, inc['tipo']):
-                pares_amb_inc.append((amb.id, inc['nodo']))
+    # Create compatible pairs: an ambulance can attend emergencies up to its own level
+    niveles_inc = np.array([NIVELES.get(inc['tipo'], 0) for inc in incidentes])
+    compatibles = flota.niveles()[:, None] >= niveles_inc[None, :]
+    pares_amb_inc = [
+        (flota.ids[i], incidentes[j]['nodo'])
+        for i, j in zip(*np.nonzero(compatibles))
+    ]
     
     if not pares_amb_inc:
         return None, "No compatible ambulance-incident pairs found"
     
-    # Create optimization model
-    modelo = LpProblem("Despacho_Ambulancias", LpMinimize)
+    # Shortest routes from the base to every destination
+    _, nodos, indice, arco_minimo = construir_csr(G)
+    # `rutas` comes from calcular_rutas, run in the script thread
+    longitudes, predecesores = rutas
     
-    # Decision variables
-    y = {}
-    for amb_id, nodo_dest in pares_amb_inc:
-        y[(amb_id, nodo_dest)] = LpVariable(f"y_{amb_id}_{nodo_dest}", cat='Binary')
+    rutas_destino = {}
+    for nodo_dest in DESTINOS:
+        fila_destino = indice[nodo_dest]
+        if np.isinf(longitudes[fila_destino]):
+            return None, f"Incident node {nodo_dest} is unreachable from the base"
+        
+        distancia = float(longitudes[fila_destino])
+        filas_camino = _reconstruir_camino(predecesores, fila_destino)
+        
+        rutas_destino[nodo_dest] = {
+            'ruta': [nodos[fila] for fila in filas_camino],
+            'arcos': [arco_minimo[par] for par in zip(filas_camino[:-1], filas_camino[1:])],
+            'distancia_km': distancia,
+            'tiempo_min': distancia / R_k[DESTINOS[nodo_dest]] * 60
+        }
     
-    x = {}
-    for amb_id, nodo_dest in pares_amb_inc:
-        for u, v, key in arcos:
-            x[(amb_id, nodo_dest, u, v, key)] = LpVariable(
-                f"x_{amb_id}_{nodo_dest}_{u}_{v}_{key}", cat='Binary'
+    # Cost of each assignment: operational cost + response time.
+    # Per destination: cost = coef_distancia * costo_operativo + coef_tiempo
+    coef_distancia = {}
+    coef_tiempo = {}
+    for nodo_dest, ruta_info in rutas_destino.items():
+        prioridad = prioridades[DESTINOS[nodo_dest]]
+        coef_distancia[nodo_dest] = prioridad * GAMMA * ruta_info['distancia_km']
+        coef_tiempo[nodo_dest] = prioridad * BETA * ruta_info['tiempo_min']
+    
+    # The fleet must cover every incident whatever the routes, so check the
+    # assignment alone before looking at capacities
+    asignados, costo_total = _asignar_ambulancias(
+        flota, incidentes, compatibles, coef_distancia, coef_tiempo
+    )
+    if asignados is None:
+        return None, (
+            "Model status: Infeasible (not enough compatible ambulances "
+            "to attend every incident)"
+        )
+    
+    # Capacity (relaxed): with shortest routes the speed load on an arc is the
+    # same whichever ambulance is assigned, so check it once per destination
+    carga = np.zeros(len(capacidades))
+    for nodo_dest, ruta_info in rutas_destino.items():
+        carga[ruta_info['arcos']] += R_k[DESTINOS[nodo_dest]]
+    
+    capacidad_relajada = capacidades * factor_relajacion
+    modelo = None
+    
+    if (carga > capacidad_relajada).any():
+        # Some arc is overloaded: detours must be chosen together with the
+        # assignment, in the multi-flow model
+        modelo, asignados, rutas_destino, costo_total = _resolver_flujo(
+            G, flota, ORIGEN, incidentes, pares_amb_inc, costo_por_amb,
+            capacidad_relajada, solver
+        )
+        if modelo.status == LpStatusInfeasible:
+            return None, (
+                "Model status: Infeasible (link capacities cannot carry every "
+                "route; increase the relaxation factor)"
             )
+        if modelo.status != LpStatusOptimal:
+            return None, f"Model status: {LpStatus[modelo.status]}"
+    elif usar_lp:
+        modelo, asignados, costo_total = _resolver_lp(
+            flota, incidentes, pares_amb_inc, costo_por_amb,
+            coef_distancia, coef_tiempo, solver
+        )
+        if modelo.status != LpStatusOptimal:
+            return None, f"Model status: {LpStatus[modelo.status]}"
+    
+    # A time-limited MILP can stop at a feasible, unproven solution
+    optimo = modelo is None or modelo.sol_status == LpSolutionOptimal
+    
+    # Extract results
+    asignaciones = []
+    rutas_optimas = {}
     
-    T = {}
+    for amb_id, nodo_dest in asignados:
+        tipo_emerg = DESTINOS[nodo_dest]
+        ruta_info = rutas_destino[nodo_dest]
+        distancia_total = ruta_info['distancia_km']
+        
+        asignaciones.append({
+            'ambulancia_id': amb_id,
+            'ambulancia_tipo': tipo_por_amb[amb_id],
+            'costo_operativo': costo_por_amb[amb_id],
+            'nodo_destino': nodo_dest,
+            'tipo_emergencia': tipo_emerg,
+            'prioridad': prioridades[tipo_emerg],
+            'tiempo_min': ruta_info['tiempo_min'],
+            'velocidad_req': R_k[tipo_emerg],
+            'distancia_km': distancia_total
+        })
+        
+        rutas_optimas[amb_id] = {
+            'ruta': ruta_info['ruta'],
+            'arcos': ruta_info['arcos'],
+            'destino': nodo_dest,
+            'distancia_km': distancia_total
+        }
+    
+    resultado = {
+        'modelo': modelo,
+        'asignaciones': asignaciones,
+        'rutas': rutas_optimas,
+        'costo_total': costo_total,
+        'optimo': optimo,
+        'origen': ORIGEN,
+        'destinos': DESTINOS,
+        'R_k': R_k,
+        'capacidades': capacidades
+    }
+    
+    return resultado, None
+
+def _asignar_ambulancias(flota, incidentes, compatibles, coef_distancia, coef_tiempo):
+    """Solve the assignment with linear_sum_assignment; (None, None) if infeasible."""
+    nodos_inc = [inc['nodo'] for inc in incidentes]
+    coef_dist = np.array([coef_distancia[nodo] for nodo in nodos_inc])
+    coef_t = np.array([coef_tiempo[nodo] for nodo in nodos_inc])
+    
+    # Cost matrix: incidents x ambulances, incompatible pairs forbidden
+    costos = coef_dist[:, None] * flota.costo_operativo[None, :] + coef_t[:, None]
+    costos[~compatibles.T] = np.inf
+    
+    try:
+        filas, columnas = linear_sum_assignment(costos)
+    except ValueError:
+        return None, None
+    if len(filas) < len(incidentes):
+        return None, None
+    
+    asignados = [
+        (flota.ids[i], nodos_inc[j])
+        for i, j in sorted(zip(columnas.tolist(), filas.tolist()))
+    ]
+    return asignados, float(costos[filas, columnas].sum())
+
+def _resolver_lp(flota, incidentes, pares_amb_inc, costo_por_amb, coef_distancia, coef_tiempo, solver):
+    """Solve the assignment as a PuLP LP; returns (modelo, asignados, costo_total)."""
+    modelo = LpProblem("Despacho_Ambulancias", LpMinimize)
+    
+    # Decision variables. Without capacity rows the model is a bipartite
+    # assignment whose vertices are integer: y can be continuous in [0, 1]
+    # and the LP optimum is still 0/1.
+    y = {}
     for amb_id, nodo_dest in pares_amb_inc:
-        T[(amb_id, nodo_dest)] = LpVariable(
-            f"T_{amb_id}_{nodo_dest}", lowBound=0, cat='Continuous'
+        y[(amb_id, nodo_dest)] = LpVariable(
+            f"y_{amb_id}_{nodo_dest}", lowBound=0, upBound=1, cat='Continuous'
         )
     
     # Constraint 1: Each incident attended by exactly one ambulance
     for inc in incidentes:
         nodo_dest = inc['nodo']
-        ambulancias_compatibles = [
-            (amb_id, nodo_dest) for amb_id, nd in pares_amb_inc if nd == nodo_dest
-        ]
-        modelo += (
-            lpSum([y[par] for par in ambulancias_compatibles]) == 1,
+        agregar_restriccion(
+            modelo,
+            ((y[par], 1) for par in pares_amb_inc if par[1] == nodo_dest),
+            LpConstraintEQ,
+            1,
             f"Incidente_{nodo_dest}_atendido"
         )
     
     # Constraint 2: Each ambulance attends at most one incident
-    for amb in ambulancias:
-        incidentes_disponibles = [
-            (amb.id, nodo_dest) for aid, nodo_dest in pares_amb_inc if aid == amb.id
-        ]
+    for amb_id in flota.ids:
+        incidentes_disponibles = [par for par in pares_amb_inc if par[0] == amb_id]
         if incidentes_disponibles:
-            modelo += (
-                lpSum([y[par] for par in incidentes_disponibles]) <= 1,
-                f"Ambulancia_{amb.id}_max1"
+            agregar_restriccion(
+                modelo,
+                ((y[par], 1) for par in incidentes_disponibles),
+                LpConstraintLE,
+                1,
+                f"Ambulancia_{amb_id}_max1"
             )
     
-    # Constraint 3: Flow conservation
-    for amb_id, nodo_dest in pares_amb_inc:
-        for nodo in nodos:
-            flujo_salida = lpSum([
-                x[(amb_id, nodo_dest, u, v, key)]
-                for u, v, key in arcos if u == nodo
-            ])
-            flujo_entrada = lpSum([
-                x[(amb_id, nodo_dest, u, v, key)]
-                for u, v, key in arcos if v == nodo
-            ])
-            
-            if nodo == ORIGEN:
-                modelo += (
-                    flujo_salida - flujo_entrada == y[(amb_id, nodo_dest)],
-                    f"Flujo_origen_{amb_id}_{nodo_dest}_{nodo}"
-                )
-            elif nodo == nodo_dest:
-                modelo += (
-                    flujo_entrada - flujo_salida == y[(amb_id, nodo_dest)],
-                    f"Flujo_destino_{amb_id}_{nodo_dest}_{nodo}"
-                )
-            else:
-                modelo += (
-                    flujo_entrada - flujo_salida == 0,
-                    f"Flujo_intermedio_{amb_id}_{nodo_dest}_{nodo}"
-                )
+    # Objective function
+    modelo += LpAffineExpression(
+        (
+            y[(amb_id, nodo_dest)],
+            coef_distancia[nodo_dest] * costo_por_amb[amb_id] +
+            coef_tiempo[nodo_dest]
+        )
+        for amb_id, nodo_dest in pares_amb_inc
+    ), "Costo_Total"
     
-    # Constraint 4: Time calculation
-    for amb_id, nodo_dest in pares_amb_inc:
-        tipo_emerg = DESTINOS[nodo_dest]
-        vel_flujo = R_k[tipo_emerg]
-        
-        tiempo_total = lpSum([
-            x[(amb_id, nodo_dest, u, v, key)] *
-            (G.edges[(u, v, key)]['Distancia'] / vel_flujo) * 60
-            for u, v, key in arcos
-        ])
-        
-        modelo += (
-            T[(amb_id, nodo_dest)] >= tiempo_total,
-            f"Tiempo_{amb_id}_{nodo_dest}"
+    # Solve
+    modelo.solve(solver)
+    
+    if modelo.status != LpStatusOptimal:
+        return modelo, [], None
+    
+    asignados = [par for par in pares_amb_inc if y[par].varValue > 0.5]
+    return modelo, asignados, value(modelo.objective)
+
+def _resolver_flujo(G, flota, ORIGEN, incidentes, pares_amb_inc, costo_por_amb,
+                    capacidad_relajada, solver):
+    """Solve routing and assignment together as a capacitated multi-flow MILP."""
+    arcos = G.graph['_arcs']
+    longitudes = longitudes_arcos_km(G).astype(np.float64)
+    _, nodos, indice, _ = construir_csr(G)
+    inc_por_nodo = {inc['nodo']: inc for inc in incidentes}
+    
+    # Arcs leaving and entering each node row (self-loops are never worth taking)
+    arcos_validos = [a for a, (u, v, _) in enumerate(arcos) if u != v]
+    salida = [[] for _ in nodos]
+    entrada = [[] for _ in nodos]
+    for a in arcos_validos:
+        u, v, _ = arcos[a]
+        salida[indice[u]].append(a)
+        entrada[indice[v]].append(a)
+    
+    modelo = LpProblem("Despacho_Ambulancias_Flujo", LpMinimize)
+    
+    # Decision variables: one route per compatible pair, used only if assigned
+    y = {
+        par: LpVariable(f"y_{par[0]}_{par[1]}", cat='Binary')
+        for par in pares_amb_inc
+    }
+    x = {
+        (amb_id, nodo_dest, a): LpVariable(f"x_{amb_id}_{nodo_dest}_{a}", cat='Binary')
+        for amb_id, nodo_dest in pares_amb_inc
+        for a in arcos_validos
+    }
+    
+    # Constraint 1: Each incident attended by exactly one ambulance
+    for inc in incidentes:
+        nodo_dest = inc['nodo']
+        agregar_restriccion(
+            modelo,
+            ((y[par], 1) for par in pares_amb_inc if par[1] == nodo_dest),
+            LpConstraintEQ,
+            1,
+            f"Incidente_{nodo_dest}_atendido"
         )
     
-    # Constraint 5: Capacity (relaxed)
-    for u, v, key in arcos:
-        capacidad = G.edges[(u, v, key)]['Capacidad_C']
-        capacidad_relajada = capacidad * factor_relajacion
-        
-        velocidades_en_arco = []
-        for amb_id, nodo_dest in pares_amb_inc:
-            tipo_emerg = DESTINOS[nodo_dest]
-            vel_req = R_k[tipo_emerg]
-            velocidades_en_arco.append(
-                x[(amb_id, nodo_dest, u, v, key)] * vel_req
+    # Constraint 2: Each ambulance attends at most one incident
+    for amb_id in flota.ids:
+        incidentes_disponibles = [par for par in pares_amb_inc if par[0] == amb_id]
+        if incidentes_disponibles:
+            agregar_restriccion(
+                modelo,
+                ((y[par], 1) for par in incidentes_disponibles),
+                LpConstraintLE,
+                1,
+                f"Ambulancia_{amb_id}_max1"
             )
-        
-        modelo += (
-            lpSum(velocidades_en_arco) <= capacidad_relajada,
-            f"Capacidad_{u}_{v}_{key}"
-        )
     
-    # Big-M constraints
+    # Constraint 3: Flow conservation, y units from ORIGEN to the destination
+    fila_origen = indice[ORIGEN]
     for amb_id, nodo_dest in pares_amb_inc:
-        modelo += (
-            T[(amb_id, nodo_dest)] <= M * y[(amb_id, nodo_dest)],
-            f"T_solo_si_asignado_{amb_id}_{nodo_dest}"
-        )
-    
-    # Objective function
-    costo_operativo = lpSum([
-        prioridades[DESTINOS[nodo_dest]] *
-        GAMMA *
-        ambulancias_dict[amb_id].costo_operativo *
-        x[(amb_id, nodo_dest, u, v, key)] *
-        G.edges[(u, v, key)]['Distancia']
-        for amb_id, nodo_dest in pares_amb_inc
-        for u, v, key in arcos
-    ])
+        fila_destino = indice[nodo_dest]
+        for fila in range(len(nodos)):
+            terminos = (
+                [(x[(amb_id, nodo_dest, a)], 1) for a in salida[fila]] +
+                [(x[(amb_id, nodo_dest, a)], -1) for a in entrada[fila]]
+            )
+            if fila == fila_origen:
+                terminos.append((y[(amb_id, nodo_dest)], -1))
+            elif fila == fila_destino:
+                terminos.append((y[(amb_id, nodo_dest)], 1))
+            agregar_restriccion(
+                modelo, terminos, LpConstraintEQ, 0, f"Flujo_{amb_id}_{nodo_dest}_{fila}"
+            )
     
-    costo_tiempo = lpSum([
-        prioridades[DESTINOS[nodo_dest]] *
-        BETA *
-        T[(amb_id, nodo_dest)]
-        for amb_id, nodo_dest in pares_amb_inc
-    ])
+    # Constraint 4: Capacity (relaxed), only on arcs that all routes together
+    # could overload
+    carga_maxima = sum(inc['velocidad_requerida'] for inc in incidentes)
+    for a in np.flatnonzero(carga_maxima > capacidad_relajada).tolist():
+        if arcos[a][0] == arcos[a][1]:
+            continue
+        agregar_restriccion(
+            modelo,
+            (
+                (x[(amb_id, nodo_dest, a)], inc_por_nodo[nodo_dest]['velocidad_requerida'])
+                for amb_id, nodo_dest in pares_amb_inc
+            ),
+            LpConstraintLE,
+            float(capacidad_relajada[a]),
+            f"Capacidad_{a}"
+        )
     
-    modelo += costo_operativo + costo_tiempo, "Costo_Total"
+    # Objective function: operational cost + response time, both per km
+    terminos = []
+    for amb_id, nodo_dest in pares_amb_inc:
+        inc = inc_por_nodo[nodo_dest]
+        coef_km = inc['prioridad'] * (
+            GAMMA * costo_por_amb[amb_id] + BETA * 60 / inc['velocidad_requerida']
+        )
+        terminos.extend(
+            (x[(amb_id, nodo_dest, a)], coef_km * longitudes[a]) for a in arcos_validos
+        )
+    modelo += LpAffineExpression(terminos), "Costo_Total"
     
     # Solve
-    modelo.solve(PULP_CBC_CMD(msg=0))
+    modelo.solve(solver)
     
     if modelo.status != LpStatusOptimal:
-        return None, f"Model status: {LpStatus[modelo.status]}"
+        return modelo, [], {}, None
     
-    # Extract results
-    asignaciones = []
-    rutas_optimas = {}
+    asignados = [par for par in pares_amb_inc if y[par].varValue > 0.5]
     
-    for amb_id, nodo_dest in pares_amb_inc:
-        if y[(amb_id, nodo_dest)].varValue == 1:
-            ambulancia = ambulancias_dict[amb_id]
-            tipo_emerg = DESTINOS[nodo_dest]
-            tiempo = T[(amb_id, nodo_dest)].varValue
-            
-            # Extract route
-            arcos_usados = []
-            distancia_total = 0
-            
-            for u, v, key in arcos:
-                if x[(amb_id, nodo_dest, u, v, key)].varValue == 1:
-                    arcos_usados.append((u, v, key))
-                    distancia_total += G.edges[(u, v, key)]['Distancia']
-            
-            # Reconstruct path
-            ruta = [ORIGEN]
-            nodo_actual = ORIGEN
-            arcos_restantes = arcos_usados.copy()
-            
-            while arcos_restantes:
-                for arco in arcos_restantes:
-                    u, v, key = arco
-                    if u == nodo_actual:
-                        ruta.append(v)
-                        nodo_actual = v
-                        arcos_restantes.remove(arco)
-                        break
-            
-            asignaciones.append({
-                'ambulancia_id': amb_id,
-                'ambulancia_tipo': ambulancia.tipo,
-                'costo_operativo': ambulancia.costo_operativo,
-                'nodo_destino': nodo_dest,
-                'tipo_emergencia': tipo_emerg,
-                'prioridad': prioridades[tipo_emerg],
-                'tiempo_min': tiempo,
-                'velocidad_req': R_k[tipo_emerg],
-                'distancia_km': distancia_total
-            })
-            
-            rutas_optimas[amb_id] = {
-                'ruta': ruta,
-                'arcos': arcos_usados,
-                'destino': nodo_dest,
-                'distancia_km': distancia_total
-            }
-    
-    resultado = {
-        'modelo': modelo,
-        'asignaciones': asignaciones,
-        'rutas': rutas_optimas,
-        'costo_total': value(modelo.objective),
-        'origen': ORIGEN,
-        'destinos': DESTINOS,
-        'R_k': R_k
-    }
+    # Follow each assigned pair's flow from ORIGEN, using every arc once
+    rutas_destino = {}
+    for amb_id, nodo_dest in asignados:
+        siguientes = {}
+        for a in arcos_validos:
+            if x[(amb_id, nodo_dest, a)].varValue > 0.5:
+                siguientes.setdefault(indice[arcos[a][0]], []).append(a)
+        
+        fila = fila_origen
+        camino = [ORIGEN]
+        arcos_ruta = []
+        while fila != indice[nodo_dest]:
+            a = siguientes[fila].pop()
+            arcos_ruta.append(a)
+            camino.append(arcos[a][1])
+            fila = indice[arcos[a][1]]
+        
+        distancia = float(longitudes[arcos_ruta].sum())
+        rutas_destino[nodo_dest] = {
+            'ruta': camino,
+            'arcos': arcos_ruta,
+            'distancia_km': distancia,
+            'tiempo_min': distancia / inc_por_nodo[nodo_dest]['velocidad_requerida'] * 60
+        }
     
-    return resultado, None
+    return modelo, asignados, rutas_destino, value(modelo.objective)
+
+def _precalcular_coords_arcos(G):
+    """Return the [lon, lat] coordinates of every street segment, once per graph."""
+    if '_coords_arcos' not in G.graph:
+        import osmnx as ox
+        
+        gdf_edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
+        G.graph['_coords_arcos'] = [
+            [[lon, lat] for lon, lat in geometria.coords]
+            for geometria in gdf_edges['geometry']
+        ]
+    return G.graph['_coords_arcos']
+
+# Map colors (RGB) by emergency type
+COLORES_TIPO = {'Crítica': [220, 20, 60], 'Media': [255, 140, 0], 'Leve': [34, 139, 34]}
 
 def crear_mapa(G, resultado):
-    """Create interactive Folium map with results."""
+    """Create interactive pydeck map with results (rendered client-side with WebGL)."""
+    import pydeck as pdk
     
     ORIGEN = resultado['origen']
-    DESTINOS = resultado['destinos']
     asignaciones = resultado['asignaciones']
     rutas_optimas = resultado['rutas']
     
-    lat_origen = G.nodes[ORIGEN]['y']
-    lon_origen = G.nodes[ORIGEN]['x']
+    indice, coords = indice_coords_nodos(G)
+    lon_origen, lat_origen = coords[indice[ORIGEN]].tolist()
     
-    m = folium.Map(
-        location=[lat_origen, lon_origen],
-        zoom_start=15,
-        tiles='OpenStreetMap'
+    # Street network
+    capa_calles = pdk.Layer(
+        'PathLayer',
+        data=pd.DataFrame({'path': _precalcular_coords_arcos(G)}),
+        get_path='path',
+        get_color=[160, 160, 160, 100],
+        width_min_pixels=1
     )
     
-    # Draw street network
-    gdf_edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
-    for _, edge in gdf_edges.iterrows():
-        line = edge['geometry']
-        folium.PolyLine(
-            locations=[(coord[1], coord[0]) for coord in line.coords],
-            color='lightgray',
-            weight=2,
-            opacity=0.4
-        ).add_to(m)
-    
-    # Colors by emergency type
-    colores_tipo = {'Crítica': 'red', 'Media': 'orange', 'Leve': 'green'}
-    
-    # Draw optimal routes
+    # Optimal routes, drawn along each arc's street geometry (a contracted
+    # arc spans several blocks)
+    arcos = G.graph['_arcs']
+    asignacion_por_amb = {a['ambulancia_id']: a for a in asignaciones}
+    filas_rutas = []
     for amb_id, ruta_info in rutas_optimas.items():
-        asig = next(a for a in asignaciones if a['ambulancia_id'] == amb_id)
+        asig = asignacion_por_amb[amb_id]
         tipo_emerg = asig['tipo_emergencia']
-        color_ruta = colores_tipo[tipo_emerg]
-        
-        ruta_coords = [
-            (G.nodes[nodo]['y'], G.nodes[nodo]['x'])
-            for nodo in ruta_info['ruta']
-        ]
-        
-        folium.PolyLine(
-            locations=ruta_coords,
-            color=color_ruta,
-            weight=5,
-            opacity=0.8,
-            popup=f"""
-            <b>{amb_id}</b><br>
-            Tipo: {asig['ambulancia_tipo']}<br>
-            Emergencia: {tipo_emerg}<br>
-            Distancia: {ruta_info['distancia_km']:.2f} km<br>
-            Tiempo: {asig['tiempo_min']:.1f} min<br>
-            Velocidad req: {asig['velocidad_req']:.1f} km/h<br>
-            Capacidad max: {G.edges[ruta_info['arcos'][0][:3]]['Capacidad_C']:.1f} km/h
-            """
-        ).add_to(m)
-    
-    # Mark origin
-    folium.Marker(
-        location=[lat_origen, lon_origen],
-        popup=f"<b>🏥 BASE</b><br>Ambulancias: {len(asignaciones)}",
-        icon=folium.Icon(color='blue', icon='home', prefix='fa')
-    ).add_to(m)
-    
-    # Mark destinations
-    iconos_tipo = {'Crítica': 'exclamation-triangle', 'Media': 'exclamation-circle', 'Leve': 'info-circle'}
+        trazado = []
+        for a in ruta_info['arcos']:
+            u, v, key = arcos[a]
+            puntos = _coords_arco(G, u, v, G[u][v][key])
+            trazado.extend(puntos[1:] if trazado else puntos)
+        filas_rutas.append({
+            'path': trazado,
+            'color': COLORES_TIPO[tipo_emerg],
+            'titulo': amb_id,
+            'detalle': (
+                f"Tipo: {asig['ambulancia_tipo']}<br/>"
+                f"Emergencia: {tipo_emerg}<br/>"
+                f"Distancia: {ruta_info['distancia_km']:.2f} km<br/>"
+                f"Tiempo: {asig['tiempo_min']:.1f} min<br/>"
+                f"Velocidad req: {asig['velocidad_req']:.1f} km/h<br/>"
+                f"Capacidad max: {resultado['capacidades'][ruta_info['arcos'][0]]:.1f} km/h"
+            )
+        })
+    
+    capa_rutas = pdk.Layer(
+        'PathLayer',
+        data=pd.DataFrame(filas_rutas),
+        get_path='path',
+        get_color='color',
+        width_min_pixels=4,
+        pickable=True
+    )
     
+    # Base and incidents
+    puntos = [{
+        'position': [lon_origen, lat_origen],
+        'color': [30, 90, 220],
+        'titulo': '🏥 BASE',
+        'detalle': f"Ambulancias: {len(asignaciones)}"
+    }]
     for asig in asignaciones:
         nodo_dest = asig['nodo_destino']
         tipo_emerg = asig['tipo_emergencia']
-        
-        lat_dest = G.nodes[nodo_dest]['y']
-        lon_dest = G.nodes[nodo_dest]['x']
-        
-        folium.Marker(
-            location=[lat_dest, lon_dest],
-            popup=f"""
-            <b>🚨 {tipo_emerg.upper()}</b><br>
-            Atendido: {asig['ambulancia_id']}<br>
-            Tiempo: {asig['tiempo_min']:.1f} min<br>
-            Velocidad: {asig['velocidad_req']:.1f} km/h
-            """,
-            icon=folium.Icon(
-                color=colores_tipo[tipo_emerg],
-                icon=iconos_tipo[tipo_emerg],
-                prefix='fa'
+        puntos.append({
+            'position': coords[indice[nodo_dest]].tolist(),
+            'color': COLORES_TIPO[tipo_emerg],
+            'titulo': f"🚨 {tipo_emerg.upper()}",
+            'detalle': (
+                f"Atendido: {asig['ambulancia_id']}<br/>"
+                f"Tiempo: {asig['tiempo_min']:.1f} min<br/>"
+                f"Velocidad: {asig['velocidad_req']:.1f} km/h"
             )
-        ).add_to(m)
-    
-    # Add legend
-    leyenda_html = f"""
-    <div style="
-    position: fixed;
-    bottom: 50px; left: 50px; width: 220px; height: 180px;
-    background-color: white; border:2px solid grey; z-index:9999;
-    font-size:14px; padding: 10px">
-    <p style="margin:0; font-weight:bold;">🚑 Leyenda</p>
-    <hr style="margin:5px 0;">
-    <p style="margin:2px 0;"><span style="color:red;">━━</span> Crítica</p>
-    <p style="margin:2px 0;"><span style="color:orange;">━━</span> Media</p>
-    <p style="margin:2px 0;"><span style="color:green;">━━</span> Leve</p>
-    <hr style="margin:5px 0;">
-    <p style="margin:2px 0;">🏥 Base</p>
-    <p style="margin:2px 0;">🚨 Incidentes</p>
-    <hr style="margin:5px 0;">
-    <p style="margin:2px 0; font-size:12px;">Costo: <b>${resultado['costo_total']:.2f}</b></p>
-    </div>
-    """
-    m.get_root().html.add_child(folium.Element(leyenda_html))
-    
-    return m
+        })
+    
+    capa_puntos = pdk.Layer(
+        'ScatterplotLayer',
+        data=pd.DataFrame(puntos),
+        get_position='position',
+        get_fill_color='color',
+        get_radius=12,
+        radius_min_pixels=6,
+        pickable=True
+    )
+    
+    return pdk.Deck(
+        layers=[capa_calles, capa_rutas, capa_puntos],
+        initial_view_state=pdk.ViewState(
+            latitude=lat_origen,
+            longitude=lon_origen,
+            zoom=15
+        ),
+        map_style=None,
+        tooltip={'html': '<b>{titulo}</b><br/>{detalle}'}
+    )
+
+def clave_resultado(G, resultado):
+    """Stable content hash of a result (its graph and capacity draw), used to key the map."""
+    asignaciones = sorted(resultado['asignaciones'], key=lambda a: a['ambulancia_id'])
+    contenido = repr((
+        G.graph['_clave'],
+        resultado['origen'],
+        resultado['costo_total'],
+        [sorted(asig.items()) for asig in asignaciones]
+    ))
+    clave = hashlib.blake2b(contenido.encode(), digest_size=16)
+    clave.update(resultado['capacidades'].tobytes())
+    return clave.hexdigest()
+
+def formatear_ruta(asig, ruta_info):
+    """Markdown body of one route's expander (a single markdown element)."""
+    ruta = ruta_info['ruta']
+    camino = " → ".join(map(str, ruta[:10])) + (" → ..." if len(ruta) > 10 else "")
+    return (
+        "| Distance | Time | Required Speed |\n"
+        "|---|---|---|\n"
+        f"| {ruta_info['distancia_km']:.3f} km | {asig['tiempo_min']:.2f} min "
+        f"| {asig['velocidad_req']:.1f} km/h |\n\n"
+        "**Route Path:**\n"
+        f"```\n{camino}\n```\n\n"
+        f"**Segments:** {len(ruta_info['arcos'])}"
+    )
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def construir_mapa(_G, _resultado, clave):
+    """Build the results map once per `clave_resultado` key."""
+    return crear_mapa(_G, _resultado)
 
 # ============================================================================
 # SESSION STATE INITIALIZATION
 # ============================================================================
 
 if 'ambulancias' not in st.session_state:
-    # Initialize with default fleet
-    st.session_state.ambulancias = [
-        Ambulancia("Amb_001", personal=3, equipamiento=5, insumos=10),   # Costo: 85 (Leve)
-        Ambulancia("Amb_002", personal=5, equipamiento=8, insumos=15),   # Costo: 135 (Media)
-        Ambulancia("Amb_003", personal=7, equipamiento=12, insumos=20),  # Costo: 190 (Media)
-        Ambulancia("Amb_004", personal=10, equipamiento=15, insumos=25), # Costo: 250 (Crítica)
-        Ambulancia("Amb_005", personal=2, equipamiento=3, insumos=5),    # Costo: 50 (Leve)
-        Ambulancia("Amb_006", personal=4, equipamiento=6, insumos=12),   # Costo: 106 (Media)
-        Ambulancia("Amb_007", personal=6, equipamiento=10, insumos=18),  # Costo: 164 (Media)
-        Ambulancia("Amb_008", personal=8, equipamiento=14, insumos=22),  # Costo: 216 (Crítica)
-        Ambulancia("Amb_009", personal=3, equipamiento=4, insumos=8),    # Costo: 74 (Leve)
-        Ambulancia("Amb_010", personal=12, equipamiento=18, insumos=30), # Costo: 300 (Crítica)
-        Ambulancia("Amb_011", personal=5, equipamiento=7, insumos=13),   # Costo: 124 (Media)
-        Ambulancia("Amb_012", personal=2, equipamiento=5, insumos=7),    # Costo: 66 (Leve)
-        Ambulancia("Amb_013", personal=7, equipamiento=9, insumos=16),   # Costo: 163 (Media)
-        Ambulancia("Amb_014", personal=9, equipamiento=13, insumos=24),  # Costo: 227 (Crítica)
-        Ambulancia("Amb_015", personal=1, equipamiento=2, insumos=4)     # Costo: 32 (Desconocido)
-    ]
+    # Initialize with default fleet: (id, personal, equipamiento, insumos)
+    st.session_state.ambulancias = Flota(*zip(*[
+        ("Amb_001", 3, 5, 10),    # Costo: 85 (Leve)
+        ("Amb_002", 5, 8, 15),    # Costo: 135 (Media)
+        ("Amb_003", 7, 12, 20),   # Costo: 190 (Media)
+        ("Amb_004", 10, 15, 25),  # Costo: 250 (Crítica)
+        ("Amb_005", 2, 3, 5),     # Costo: 50 (Leve)
+        ("Amb_006", 4, 6, 12),    # Costo: 106 (Media)
+        ("Amb_007", 6, 10, 18),   # Costo: 164 (Media)
+        ("Amb_008", 8, 14, 22),   # Costo: 216 (Crítica)
+        ("Amb_009", 3, 4, 8),     # Costo: 74 (Leve)
+        ("Amb_010", 12, 18, 30),  # Costo: 300 (Crítica)
+        ("Amb_011", 5, 7, 13),    # Costo: 124 (Media)
+        ("Amb_012", 2, 5, 7),     # Costo: 66 (Leve)
+        ("Amb_013", 7, 9, 16),    # Costo: 163 (Media)
+        ("Amb_014", 9, 13, 24),   # Costo: 227 (Crítica)
+        ("Amb_015", 1, 2, 4)      # Costo: 32 (Desconocido)
+    ]))
+
+# Bumped on every fleet add/remove so the fleet table is rebuilt only then
+if 'fleet_version' not in st.session_state:
+    st.session_state.fleet_version = 0
+
+if 'fleet_df' not in st.session_state:
+    st.session_state.fleet_df = None
+
+if 'fleet_df_version' not in st.session_state:
+    st.session_state.fleet_df_version = None
 
 if 'G' not in st.session_state:
     st.session_state.G = None
@@ -566,6 +932,18 @@ if 'resultado' not in st.session_state:
 if 'R_k' not in st.session_state:
     st.session_state.R_k = None
 
+# This session's link capacities (uint8 km/h aligned with G.graph['_arcs'])
+# and the (graph, parameters, seed) key they were drawn with
+if 'capacidades' not in st.session_state:
+    st.session_state.capacidades = None
+
+if 'clave_capacidades' not in st.session_state:
+    st.session_state.clave_capacidades = None
+
+# Seed of the capacity draw; bumped by "Recalculate Capacities"
+if 'capacity_seed' not in st.session_state:
+    st.session_state.capacity_seed = int(time.time())
+
 # Default parameters
 if 'num_incidentes' not in st.session_state:
     st.session_state.num_incidentes = 5
@@ -585,15 +963,35 @@ if 'C_MAX' not in st.session_state:
 if 'FACTOR_RELAJACION' not in st.session_state:
     st.session_state.FACTOR_RELAJACION = 1.0
 
+if 'EXACT_CENTRALITY' not in st.session_state:
+    st.session_state.EXACT_CENTRALITY = False
+
+if 'USE_LP' not in st.session_state:
+    st.session_state.USE_LP = False
+
+if 'TIME_LIMIT' not in st.session_state:
+    st.session_state.TIME_LIMIT = 60
+
 if 'ORIGEN' not in st.session_state:
     st.session_state.ORIGEN = None
 
 if 'DESTINOS' not in st.session_state:
     st.session_state.DESTINOS = None
 
+# Incidents per emergency type, counted once when incidents are generated
+if 'tipos_count' not in st.session_state:
+    st.session_state.tipos_count = {}
+
 if 'incidentes_generados' not in st.session_state:
     st.session_state.incidentes_generados = False
 
+if 'optimizacion_completada' not in st.session_state:
+    st.session_state.optimizacion_completada = False
+
+# Future of the optimization running in the background, if any
+if 'opt_future' not in st.session_state:
+    st.session_state.opt_future = None
+
 # ============================================================================
 # STREAMLIT UI
 # ============================================================================
@@ -652,6 +1050,27 @@ with st.sidebar:
         help="Capacity relaxation multiplier (allows sum of speeds to exceed link capacity)"
     )
     
+    st.session_state.USE_LP = st.checkbox(
+        "LP solver (PuLP)",
+        value=st.session_state.USE_LP,
+        help="Solve the assignment as a PuLP LP instead of SciPy's linear_sum_assignment"
+    )
+    
+    st.session_state.TIME_LIMIT = st.number_input(
+        "Solver Time Limit (s)",
+        min_value=5,
+        max_value=600,
+        value=st.session_state.TIME_LIMIT,
+        step=5,
+        help="Maximum time the PuLP solver may spend (LP mode, or when link capacities bind)"
+    )
+    
+    st.session_state.EXACT_CENTRALITY = st.checkbox(
+        "Exact centrality",
+        value=st.session_state.EXACT_CENTRALITY,
+        help="Compute exact betweenness centrality to choose the base (slow on large networks)"
+    )
+    
     st.divider()
     
     st.info(f"""
@@ -660,18 +1079,35 @@ with st.sidebar:
     - Radius: {RADIO_METROS}m
     - β (time weight): {BETA}
     - γ (cost weight): {GAMMA}
+    - Solver: {'' if st.session_state.USE_LP else 'linear_sum_assignment / '}{obtener_solver(st.session_state.TIME_LIMIT).name}
     
     **Current Relaxation:** {st.session_state.FACTOR_RELAJACION}x
     """)
+    
+    if st.button("🧹 Clear network cache", use_container_width=True):
+        descargar_red.clear()
+        calcular_rutas.clear()
+        construir_mapa.clear()
+        ruta_red = _ruta_red_en_disco(LATITUD_CENTRO, LONGITUD_CENTRO, RADIO_METROS)
+        if os.path.exists(ruta_red):
+            os.remove(ruta_red)
+        st.session_state.G = None
+        st.session_state.R_k = None
+        st.session_state.capacidades = None
+        st.session_state.clave_capacidades = None
+        st.success("Network cache cleared")
 
-# Main content
-tab1, tab2, tab3, tab4 = st.tabs(["🚑 Fleet Management", "🚨 Incidents", "🎯 Optimization", "📊 Results"])
+# Street network (shared by all tabs)
+if st.session_state.G is None:
+    st.session_state.G = cargar_red()
 
 # ============================================================================
 # TAB 1: FLEET MANAGEMENT
 # ============================================================================
 
-with tab1:
+@st.fragment
+def render_tab1():
+    """Fleet table, add and remove ambulances."""
     st.header("🚑 Ambulance Fleet Management")
     
     col1, col2 = st.columns([2, 1])
@@ -680,20 +1116,23 @@ with tab1:
         st.subheader("Current Fleet")
         
         if st.session_state.ambulancias:
-            df_ambulancias = pd.DataFrame([amb.to_dict() for amb in st.session_state.ambulancias])
-            
-            # Style the dataframe
-            def color_tipo(val):
-                colors = {'Crítica': 'background-color: #ffcccc',
-                         'Media': 'background-color: #ffe6cc',
-                         'Leve': 'background-color: #ccffcc'}
-                return colors.get(val, '')
+            # Build and style the fleet table only when the fleet changes
+            if st.session_state.fleet_df_version != st.session_state.fleet_version:
+                def color_tipo(val):
+                    colors = {'Crítica': 'background-color: #ffcccc',
+                             'Media': 'background-color: #ffe6cc',
+                             'Leve': 'background-color: #ccffcc'}
+                    return colors.get(val, '')
+                
+                st.session_state.fleet_df = st.session_state.ambulancias.to_dataframe().style.map(
+                    color_tipo, subset=['Tipo']
+                )
+                st.session_state.fleet_df_version = st.session_state.fleet_version
             
-            styled_df = df_ambulancias.style.applymap(color_tipo, subset=['Tipo'])
-            st.dataframe(styled_df, use_container_width=True, hide_index=True)
+            st.dataframe(st.session_state.fleet_df, use_container_width=True, hide_index=True)
             
             # Fleet statistics
-            tipos_count = Counter([amb.tipo for amb in st.session_state.ambulancias])
+            tipos_count = Counter(st.session_state.ambulancias.tipo)
             col_a, col_b, col_c, col_d = st.columns(4)
             col_a.metric("Total Ambulances", len(st.session_state.ambulancias))
             col_b.metric("Critical", tipos_count.get('Crítica', 0))
@@ -736,18 +1175,8 @@ with tab1:
             )
             
             # Preview operational cost
-            preview_cost = (new_personal * COEF_PERSONAL + 
-                          new_equipamiento * COEF_EQUIPAMIENTO + 
-                          new_insumos * COEF_INSUMOS)
-            
-            if preview_cost >= 200:
-                preview_tipo = 'Crítica'
-            elif preview_cost >= 100:
-                preview_tipo = 'Media'
-            elif preview_cost >= 50:
-                preview_tipo = 'Leve'
-            else:
-                preview_tipo = 'Desconocido'
+            preview_cost = calcular_costo_operativo(new_personal, new_equipamiento, new_insumos)
+            preview_tipo = tipo_ambulancia(preview_cost)
             
             st.info(f"**Preview:** Cost: ${preview_cost} → Type: {preview_tipo}")
             
@@ -755,11 +1184,13 @@ with tab1:
             
             if submitted:
                 # Check if ID already exists
-                if any(amb.id == new_id for amb in st.session_state.ambulancias):
+                if new_id in st.session_state.ambulancias:
                     st.error(f"ID '{new_id}' already exists!")
                 else:
-                    nueva_amb = Ambulancia(new_id, new_personal, new_equipamiento, new_insumos)
-                    st.session_state.ambulancias.append(nueva_amb)
+                    st.session_state.ambulancias.agregar(
+                        new_id, new_personal, new_equipamiento, new_insumos
+                    )
+                    st.session_state.fleet_version += 1
                     st.success(f"✅ {new_id} added successfully!")
                     st.rerun()
     
@@ -773,16 +1204,14 @@ with tab1:
         with col_remove1:
             amb_to_remove = st.selectbox(
                 "Select ambulance to remove:",
-                options=[amb.id for amb in st.session_state.ambulancias],
+                options=st.session_state.ambulancias.ids.tolist(),
                 key="remove_selectbox"
             )
         
         with col_remove2:
             if st.button("🗑️ Remove", use_container_width=True, type="secondary"):
-                st.session_state.ambulancias = [
-                    amb for amb in st.session_state.ambulancias 
-                    if amb.id != amb_to_remove
-                ]
+                st.session_state.ambulancias.eliminar(amb_to_remove)
+                st.session_state.fleet_version += 1
                 st.success(f"Removed {amb_to_remove}")
                 st.rerun()
 
@@ -790,7 +1219,40 @@ with tab1:
 # TAB 2: INCIDENTS
 # ============================================================================
 
-with tab2:
+def _mostrar_aviso(clave):
+    """Show (once) the message a button callback left under `clave`."""
+    aviso = st.session_state.pop(clave, None)
+    if aviso is not None:
+        tipo, texto = aviso
+        if tipo == 'error':
+            st.error(texto)
+        else:
+            st.success(texto)
+
+def _al_generar_incidentes():
+    """'Generate Incidents' callback: draws new incidents into session state."""
+    if st.session_state.G is None:
+        st.session_state.aviso_incidentes = (
+            'error', "❌ Failed to download network. Check your internet connection."
+        )
+        return
+    
+    random.seed(int(time.time()))
+    ORIGEN, DESTINOS = generar_origen_destinos(
+        st.session_state.G,
+        st.session_state.num_incidentes,
+        st.session_state.EXACT_CENTRALITY
+    )
+    st.session_state.ORIGEN = ORIGEN
+    st.session_state.DESTINOS = DESTINOS
+    st.session_state.tipos_count = dict(Counter(DESTINOS.values()))
+    st.session_state.incidentes_generados = True
+    st.session_state.incidentes_nuevos = True
+    st.session_state.aviso_incidentes = ('success', f"✅ Generated {len(DESTINOS)} incidents!")
+
+@st.fragment
+def render_tab2():
+    """Incident generation and incident table."""
     st.header("🚨 Incident Management")
     
     col1, col2 = st.columns([1, 1])
@@ -809,41 +1271,29 @@ with tab2:
         
         st.divider()
         
-        # Button to generate incidents
-        if st.button("🔄 Generate Incidents", use_container_width=True, type="primary"):
-            # Auto-load network if not loaded
-            if st.session_state.G is None:
-                with st.spinner("📡 Loading street network (first time)..."):
-                    G = descargar_red(LATITUD_CENTRO, LONGITUD_CENTRO, RADIO_METROS)
-                    if G is None:
-                        st.error("❌ Failed to download network. Check your internet connection.")
-                        st.stop()
-                    st.session_state.G = G
-                    st.success(f"✅ Network loaded: {len(G.nodes())} nodes")
-            
-            # Generate incidents
-            with st.spinner("🔄 Generating incident locations and types..."):
-                random.seed(int(time.time()))
-                ORIGEN, DESTINOS = generar_origen_destinos(
-                    st.session_state.G,
-                    st.session_state.num_incidentes
-                )
-                st.session_state.ORIGEN = ORIGEN
-                st.session_state.DESTINOS = DESTINOS
-                st.session_state.incidentes_generados = True
-                st.success(f"✅ Generated {len(DESTINOS)} incidents!")
-                st.rerun()
+        # Button to generate incidents. Its callback only reruns this fragment,
+        # so rerun the whole app once: the Optimization tab shows the incident
+        # status too. Callbacks cannot call st.rerun() themselves.
+        st.button(
+            "🔄 Generate Incidents",
+            use_container_width=True,
+            type="primary",
+            on_click=_al_generar_incidentes
+        )
+        if st.session_state.pop('incidentes_nuevos', False):
+            st.rerun()
+        _mostrar_aviso('aviso_incidentes')
         
         # Network status
         if st.session_state.G is None:
-            st.info(f"""
+            st.warning(f"""
             **Current Configuration:**
             - Requested Incidents: {st.session_state.num_incidentes}
             - Available Ambulances: {len(st.session_state.ambulancias)}
             - Location: Medellín, Colombia
             - Coverage Radius: {RADIO_METROS}m
             
-            ℹ️ **Network will load automatically when you generate incidents**
+            ⚠️ **Street network could not be loaded**
             """)
         else:
             st.success(f"""
@@ -861,8 +1311,7 @@ with tab2:
         if not st.session_state.incidentes_generados or st.session_state.DESTINOS is None:
             st.warning("⚠️ No incidents generated yet. Click **Generate Incidents** button.")
         else:
-            # Count incidents by type
-            tipos_incidentes = Counter(st.session_state.DESTINOS.values())
+            tipos_incidentes = st.session_state.tipos_count
             
             # Display metrics
             col_a, col_b, col_c = st.columns(3)
@@ -877,28 +1326,25 @@ with tab2:
             # Show incidents table
             st.subheader("📍 Incident Details")
             
-            incidentes_data = []
-            for nodo, tipo in st.session_state.DESTINOS.items():
-                incidentes_data.append({
-                    'Node ID': nodo,
-                    'Type': tipo,
-                    'Priority': {'Crítica': 3, 'Media': 2, 'Leve': 1}[tipo]
-                })
-            
-            df_incidentes = pd.DataFrame(incidentes_data)
+            # Severity shown as an emoji column (plain text, no per-cell CSS)
+            tipos = pd.Series(list(st.session_state.DESTINOS.values()), dtype=object)
+            df_incidentes = pd.DataFrame({
+                'Sev': tipos.map({'Crítica': '🔴', 'Media': '🟠', 'Leve': '🟢'}),
+                'Node ID': np.fromiter(st.session_state.DESTINOS.keys(), dtype=np.int64),
+                'Type': tipos,
+                'Priority': tipos.map(NIVELES)
+            })
             df_incidentes = df_incidentes.sort_values('Priority', ascending=False)
             
-            # Style the dataframe
-            def color_tipo_incident(row):
-                colors = {
-                    'Crítica': 'background-color: #ffcccc',
-                    'Media': 'background-color: #ffe6cc',
-                    'Leve': 'background-color: #ccffcc'
+            st.dataframe(
+                df_incidentes,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    'Sev': st.column_config.TextColumn("", width="small"),
+                    'Type': st.column_config.TextColumn("Type")
                 }
-                return [colors.get(row['Type'], '')] * len(row)
-            
-            styled_df_inc = df_incidentes.style.apply(color_tipo_incident, axis=1)
-            st.dataframe(styled_df_inc, use_container_width=True, hide_index=True)
+            )
     
     st.divider()
     
@@ -937,24 +1383,111 @@ with tab2:
 # TAB 3: OPTIMIZATION
 # ============================================================================
 
-with tab3:
+def _capacidades_sesion():
+    """Return this session's (capacidades, R_k), redrawn only when inputs change."""
+    G = st.session_state.G
+    parametros = (
+        st.session_state.C_MIN,
+        st.session_state.C_MAX,
+        st.session_state.R_MIN,
+        st.session_state.R_MAX,
+        st.session_state.capacity_seed
+    )
+    clave = (G.graph['_clave'],) + parametros
+    if st.session_state.clave_capacidades != clave:
+        st.session_state.capacidades, st.session_state.R_k = asignar_capacidades_velocidades(
+            len(G.graph['_arcs']), *parametros
+        )
+        st.session_state.clave_capacidades = clave
+    return st.session_state.capacidades, st.session_state.R_k
+
+def _al_recalcular_capacidades():
+    """'Recalculate Capacities' callback: draws capacities with a new seed."""
+    if st.session_state.G is None:
+        return
+    
+    st.session_state.capacity_seed += 1
+    _capacidades_sesion()
+    st.session_state.aviso_capacidades = ('success', "✅ Capacities recalculated!")
+
+def _al_ejecutar_optimizacion():
+    """'Run Optimization' callback: submits the model to a worker thread."""
+    if st.session_state.G is None:
+        st.session_state.aviso_optimizacion = ('error', "❌ Network not loaded!")
+        return
+    if len(st.session_state.ambulancias) == 0:
+        st.session_state.aviso_optimizacion = ('error', "❌ No ambulances in fleet!")
+        return
+    if not st.session_state.incidentes_generados or st.session_state.DESTINOS is None:
+        st.session_state.aviso_optimizacion = (
+            'error', "❌ No incidents generated! Go to Incidents tab and generate incidents first."
+        )
+        return
+    
+    G = st.session_state.G
+    capacidades, R_k = _capacidades_sesion()
+    rutas = calcular_rutas(G, G.graph['_clave'], st.session_state.ORIGEN)
+    
+    # Solve in a worker thread; the fleet is copied so edits in the Fleet tab
+    # cannot change it mid-solve
+    flota = st.session_state.ambulancias
+    st.session_state.opt_future = obtener_ejecutor().submit(
+        resolver_optimizacion,
+        G,
+        Flota(flota.ids, flota.personal, flota.equipamiento, flota.insumos),
+        st.session_state.ORIGEN,
+        st.session_state.DESTINOS,
+        R_k,
+        capacidades,
+        rutas,
+        st.session_state.FACTOR_RELAJACION,
+        obtener_solver(st.session_state.TIME_LIMIT),
+        st.session_state.USE_LP
+    )
+    st.session_state.optimizacion_enviada = True
+
+@st.fragment(run_every=0.5)
+def seguimiento_optimizacion():
+    """Poll the background optimization; drawn only while one is running."""
+    futuro = st.session_state.opt_future
+    if futuro is None:
+        return
+    
+    if not futuro.done():
+        with st.status("🔄 Running optimization model...", expanded=False):
+            st.write("Other tabs stay usable while the model is solved.")
+        return
+    
+    st.session_state.opt_future = None
+    try:
+        resultado, error = futuro.result()
+    except Exception as e:
+        resultado, error = None, str(e)
+    
+    if error:
+        st.session_state.aviso_optimizacion = ('error', f"❌ Optimization failed: {error}")
+    else:
+        st.session_state.resultado = resultado
+        st.session_state.optimizacion_completada = True
+    
+    # Rerun the whole app so the Results tab shows the new result (this
+    # fragment is not drawn again, which stops the polling)
+    st.rerun()
+
+@st.fragment
+def render_tab3():
+    """Capacity recalculation and optimization run."""
     st.header("🎯 Optimization Control")
     
-    # Load network if not loaded
+    # Network status
     if st.session_state.G is None:
-        with st.spinner("📡 Downloading street network..."):
-            G = descargar_red(LATITUD_CENTRO, LONGITUD_CENTRO, RADIO_METROS)
-            if G is not None:
-                st.session_state.G = G
-                st.success(f"✅ Network loaded: {len(G.nodes())} nodes, {len(G.edges())} edges")
-            else:
-                st.error("❌ Failed to load network")
+        st.error("❌ Failed to load network")
     else:
         st.info(f"✅ Network ready: {len(st.session_state.G.nodes())} nodes, {len(st.session_state.G.edges())} edges")
     
     # Show incident status
     if st.session_state.incidentes_generados and st.session_state.DESTINOS is not None:
-        tipos_count = Counter(st.session_state.DESTINOS.values())
+        tipos_count = st.session_state.tipos_count
         st.success(f"""
         ✅ **Incidents Ready:** {len(st.session_state.DESTINOS)} incidents generated
         - 🔴 Critical: {tipos_count.get('Crítica', 0)} | 🟠 Medium: {tipos_count.get('Media', 0)} | 🟢 Light: {tipos_count.get('Leve', 0)}
@@ -964,75 +1497,55 @@ with tab3:
     
     st.divider()
     
+    # Button callbacks only change session state; this render path reads it
+    optimizando = st.session_state.opt_future is not None
+    
     col1, col2 = st.columns(2)
     
     with col1:
-        if st.button("🔄 Recalculate Capacities", use_container_width=True, type="secondary"):
-            if st.session_state.G is not None:
-                with st.spinner("🔄 Recalculating link capacities..."):
-                    random.seed(int(time.time()))
-                    R_k = asignar_capacidades_velocidades(
-                        st.session_state.G,
-                        st.session_state.C_MIN,
-                        st.session_state.C_MAX,
-                        st.session_state.R_MIN,
-                        st.session_state.R_MAX
-                    )
-                    st.session_state.R_k = R_k
-                    st.success("✅ Capacities recalculated!")
-                    
-                    # Show speed requirements
-                    st.subheader("Speed Requirements by Type")
-                    for tipo, vel in sorted(R_k.items(), key=lambda x: x[1]):
-                        st.metric(f"{tipo}", f"{vel:.1f} km/h")
+        st.button(
+            "🔄 Recalculate Capacities",
+            use_container_width=True,
+            type="secondary",
+            disabled=optimizando,
+            on_click=_al_recalcular_capacidades
+        )
+        if 'aviso_capacidades' in st.session_state:
+            _mostrar_aviso('aviso_capacidades')
+            
+            # Show speed requirements
+            st.subheader("Speed Requirements by Type")
+            for tipo, vel in sorted(st.session_state.R_k.items(), key=lambda x: x[1]):
+                st.metric(f"{tipo}", f"{vel:.1f} km/h")
     
     with col2:
-        if st.button("⚡ Recalculate Flows (Run Optimization)", use_container_width=True, type="primary"):
-            if st.session_state.G is None:
-                st.error("❌ Network not loaded!")
-            elif len(st.session_state.ambulancias) == 0:
-                st.error("❌ No ambulances in fleet!")
-            elif not st.session_state.incidentes_generados or st.session_state.DESTINOS is None:
-                st.error("❌ No incidents generated! Go to Incidents tab and generate incidents first.")
-            else:
-                with st.spinner("🔄 Running optimization model..."):
-                    # Use generated incidents from session state
-                    ORIGEN = st.session_state.ORIGEN
-                    DESTINOS = st.session_state.DESTINOS
-                    
-                    # Assign capacities if not done
-                    if st.session_state.R_k is None:
-                        R_k = asignar_capacidades_velocidades(
-                            st.session_state.G,
-                            st.session_state.C_MIN,
-                            st.session_state.C_MAX,
-                            st.session_state.R_MIN,
-                            st.session_state.R_MAX
-                        )
-                        st.session_state.R_k = R_k
-                    
-                    # Solve optimization
-                    resultado, error = resolver_optimizacion(
-                        st.session_state.G,
-                        st.session_state.ambulancias,
-                        ORIGEN,
-                        DESTINOS,
-                        st.session_state.R_k,
-                        st.session_state.FACTOR_RELAJACION
-                    )
-                    
-                    if error:
-                        st.error(f"❌ Optimization failed: {error}")
-                    else:
-                        st.session_state.resultado = resultado
-                        st.success("✅ Optimization completed successfully!")
-                        st.balloons()
+        st.button(
+            "⚡ Recalculate Flows (Run Optimization)",
+            use_container_width=True,
+            type="primary",
+            disabled=optimizando,
+            on_click=_al_ejecutar_optimizacion
+        )
+        # The polling fragment is drawn by the full app run, not by this one
+        if st.session_state.pop('optimizacion_enviada', False):
+            st.rerun()
+        _mostrar_aviso('aviso_optimizacion')
+    
+    if st.session_state.optimizacion_completada:
+        st.session_state.optimizacion_completada = False
+        if st.session_state.resultado['optimo']:
+            st.success("✅ Optimization completed successfully!")
+            st.balloons()
+        else:
+            st.warning("⏱️ Time limit reached: showing the best solution found, not proven optimal.")
 
 # ============================================================================
 # TAB 4: RESULTS
 # ============================================================================
 
-with tab4:
+@st.fragment
+def render_tab4():
+    """Optimization results, map and route details."""
     st.header("📊 Optimization Results")
     
     if st.session_state.resultado is None:
@@ -1042,14 +1555,21 @@ with tab4:
         
         # Summary metrics
         st.subheader("📈 Summary")
-        col1, col2, col3, col4 = st.columns(4)
         
-        col1.metric("Total Cost", f"${resultado['costo_total']:.2f}")
-        col2.metric("Dispatched", len(resultado['asignaciones']))
-        col3.metric("Available", len(st.session_state.ambulancias) - len(resultado['asignaciones']))
+        if not resultado['optimo']:
+            st.warning("⏱️ Solver time limit reached: this solution is not proven optimal.")
         
         avg_time = sum([a['tiempo_min'] for a in resultado['asignaciones']]) / len(resultado['asignaciones'])
-        col4.metric("Avg Response Time", f"{avg_time:.1f} min")
+        st.dataframe(
+            pd.DataFrame([{
+                'Total Cost': f"${resultado['costo_total']:.2f}",
+                'Dispatched': len(resultado['asignaciones']),
+                'Available': len(st.session_state.ambulancias) - len(resultado['asignaciones']),
+                'Avg Response Time': f"{avg_time:.1f} min"
+            }]),
+            use_container_width=True,
+            hide_index=True
+        )
         
         st.divider()
         
@@ -1082,18 +1602,17 @@ with tab4:
         st.subheader("🗺️ Route Visualization")
         
         with st.spinner("🗺️ Generating map..."):
-            mapa = crear_mapa(st.session_state.G, resultado)
-            
-            # Save map to HTML string
-            from io import BytesIO
-            import base64
-            
-            # Convert map to HTML
-            map_html = mapa._repr_html_()
-            
-            # Display using components.html
-            import streamlit.components.v1 as components
-            components.html(map_html, height=600, scrolling=True)
+            mapa = construir_mapa(
+                st.session_state.G,
+                resultado,
+                clave_resultado(st.session_state.G, resultado)
+            )
+        st.pydeck_chart(mapa)
+        
+        st.markdown(
+            ":red[━━] Crítica &nbsp; :orange[━━] Media &nbsp; :green[━━] Leve &nbsp; "
+            f"🏥 Base &nbsp; 🚨 Incidentes &nbsp; | &nbsp; Costo: **\\${resultado['costo_total']:.2f}**"
+        )
         
         st.divider()
         
@@ -1105,17 +1624,24 @@ with tab4:
             ruta_info = resultado['rutas'][amb_id]
             
             with st.expander(f"📍 {amb_id} → {asig['tipo_emergencia']} Emergency"):
-                col_a, col_b, col_c = st.columns(3)
-                
-                col_a.metric("Distance", f"{ruta_info['distancia_km']:.3f} km")
-                col_b.metric("Time", f"{asig['tiempo_min']:.2f} min")
-                col_c.metric("Required Speed", f"{asig['velocidad_req']:.1f} km/h")
-                
-                st.write("**Route Path:**")
-                st.code(" → ".join(map(str, ruta_info['ruta'][:10])) + 
-                       (" → ..." if len(ruta_info['ruta']) > 10 else ""))
-                
-                st.write(f"**Segments:** {len(ruta_info['arcos'])}")
+                st.markdown(formatear_ruta(asig, ruta_info))
+
+# Main content: each tab is a fragment, so its widgets only rerun that tab
+tab1, tab2, tab3, tab4 = st.tabs(["🚑 Fleet Management", "🚨 Incidents", "🎯 Optimization", "📊 Results"])
+
+with tab1:
+    render_tab1()
+
+with tab2:
+    render_tab2()
+
+with tab3:
+    render_tab3()
+    if st.session_state.opt_future is not None:
+        seguimiento_optimizacion()
+
+with tab4:
+    render_tab4()
 
 # Footer
 st.divider()